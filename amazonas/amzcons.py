@@ -105,20 +105,29 @@ class ConsoleCommand(Command):
         self.client = util.http.APIClientV01(host, port)
 
     def cmd_print(self, *args):
-        '''[-e <entrypoint>]
+        '''[-e <entrypoint>] [-b <budget>]
         Generate a text and display it / its score.
+        If -b is specified, the generation gives up after <budget>
+        seconds and returns the best text found until then.
         '''
         try:
-            opts, args = getopt.gnu_getopt(args, 'e:')
+            opts, args = getopt.gnu_getopt(args, 'e:b:')
         except getopt.error:
             return self.printhelp()
 
         entrypoint = None
+        budget = None
         for opt, optarg in opts:
             if opt == '-e':
                 entrypoint = optarg
-
-        score, text = self.client.generate(self.instance, entrypoint)
+            elif opt == '-b':
+                try:
+                    budget = float(optarg)
+                except ValueError:
+                    return self.printhelp()
+
+        score, text = self.client.generate(self.instance, entrypoint,
+                                           budget=budget)
         if None not in (score, text):
             self.print('%s [%f]' % (text, score))
         else:
@@ -160,10 +169,12 @@ class ConsoleCommand(Command):
             self.print('[failed]')
 
     def cmd_key(self, *args):
-        '''(no arguments required)
-        Display keys of the Markov Table.
+        '''[<pattern>]
+        Display keys of the Markov Table.  A glob-style pattern filters
+        keys by their JSON representation, e.g. '[[]"foo", *'.
         '''
-        keys = self.client.keys(self.instance)
+        keys = self.client.keys(self.instance,
+                                match=args[0] if args else None)
         if keys is None:
             return self.print('[failed]')
         for k in keys:
@@ -174,8 +185,8 @@ class ConsoleCommand(Command):
 
     def cmd_value(self, *args):
         '''<key1> [<key2> [...]]
-        Get values of the Markov Table on specified key(s).
-        Keys can be shown by the "key" command.
+        Get values and their counts of the Markov Table on specified
+        key(s).  Keys can be shown by the "key" command.
         '''
         if not args:
             return self.printhelp()
@@ -183,15 +194,17 @@ class ConsoleCommand(Command):
         values = self.client.values(self.instance, args)
         if values is None:
             return self.print('[failed]')
-        for v in values:
+        for v, n in values:
             json.dump(v, self.FILE, ensure_ascii=False)
-            self.print()
+            self.print(' %d' % n)
 
     def cmd_entry(self, *args):
-        '''(no arguments required)
-        Display candidate entrypoints to generate a text.
+        '''[<pattern>]
+        Display candidate entrypoints to generate a text.  A glob-style
+        pattern filters them by their JSON representation.
         '''
-        entries = self.client.entries(self.instance)
+        entries = self.client.entries(self.instance,
+                                      match=args[0] if args else None)
         if entries is None:
             return self.print('[failed]')
         for e in entries:
@@ -233,6 +246,20 @@ class ConsoleCommand(Command):
         self.print('markov keys:     %d' % stats['keys'])
         self.print('entrypoints:     %d' % stats['entrypoints'])
 
+        for name in ('distance', 'score'):
+            hits = stats.get('%s_cache_hits' % name)
+            misses = stats.get('%s_cache_misses' % name)
+            if None not in (hits, misses):
+                self.print('%-16s %d hits / %d misses' % (
+                    '%s cache:' % name, hits, misses))
+
+        for name in ('markov', 'entrypoint'):
+            size = stats.get('%s_bytes' % name)
+            evictions = stats.get('%s_evictions' % name)
+            if None not in (size, evictions):
+                self.print('%-16s %d bytes / %d evictions' % (
+                    '%s size:' % name, size, evictions))
+
 
 def main():
     ap = argparse.ArgumentParser()
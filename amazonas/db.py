@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import json
+import fnmatch
 import importlib
 import contextlib
 import collections
 
 import six
+from six.moves import range
 
 
 DBTYPE_MARKOV = 'markov'
@@ -55,18 +57,49 @@ class Database(object):
     def get(self, key):
         return []
 
+    def counts(self, key):
+        vals = self.get(key)
+        if not vals:
+            return None
+
+        counts = collections.OrderedDict()
+        for item in vals:
+            item = self.serialize(item)
+            counts[item] = counts.get(item, 0) + 1
+
+        return [(self.deserialize(k), n) for k, n in six.iteritems(counts)]
+
     def getrand(self, key):
         pass
 
     def getrandall(self):
         pass
 
+    def walk(self, key, maxchain):
+        key = list(key)
+        for x in range(maxchain):
+            item = self.getrand(tuple(key))
+            if item is None:
+                break
+            yield item
+            key.pop(0)
+            key.append(item)
+
     def keys(self):
         return []
 
+    def iterkeys(self, pattern=None):
+        for key in self.keys():
+            if pattern is None or \
+                    fnmatch.fnmatchcase(self.serialize(key), pattern):
+                yield key
+
     def length(self):
         return 0
 
+    def stats(self):
+        return {}
+
     def __len__(self):
         return self.length()
 
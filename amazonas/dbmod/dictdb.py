@@ -1,72 +1,998 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
 import json
+import mmap
+import array
 import fcntl
-import errno
 import codecs
+import heapq
 import random
+import struct
+import threading
+import contextlib
+
+import six
 
 from .. import db
 
+from six.moves import range
+
+
+def unpack(data, typecode='I'):
+    a = array.array(typecode)
+    if six.PY2:
+        a.fromstring(data)
+    else:
+        a.frombytes(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def pack(a):
+    if sys.byteorder != 'little':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tostring() if six.PY2 else a.tobytes()
+
+
+class Snapshot(object):
+    # read-only view of a binary snapshot, paged in through mmap.
+    #
+    #   header
+    #   token index   u64[nr_tokens + 1]  offsets into token data
+    #   token order   u32[nr_tokens]      token ids sorted by their bytes
+    #   token data    serialized tokens
+    #   successors    u32[n] ids followed by u32[n] counts, for each key
+    #   key index     u64[nr_keys + 1]    offsets into key data
+    #   succ index    u64[nr_keys + 1]    offsets into successors
+    #   key data      u32 (arity, ids...) or (SCALAR, id), sorted
+    MAGIC = b'AMZD'
+    VERSION = 1
+    SCALAR = 0xffffffff
+    OFFSET = 'Q' if six.PY3 else 'L'
+    HEADER = struct.Struct('<4sIQII7Q')
+
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_SH)
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.generation, self.nr_tokens, self.nr_keys,
+         self.token_index, self.token_order, self.token_data,
+         self.succ_data, self.key_index, self.succ_index,
+         self.key_data) = self.HEADER.unpack_from(self.mm, 0)
+
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('unsupported snapshot: %s' % path)
+
+    @classmethod
+    def probe(cls, path):
+        with open(path, 'rb') as fp:
+            return fp.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def normalize(cls, key):
+        if isinstance(key, tuple):
+            return (len(key),) + key
+        return (cls.SCALAR, key)
+
+    @classmethod
+    def denormalize(cls, nkey):
+        if nkey[0] == cls.SCALAR:
+            return nkey[1]
+        return nkey[1:]
+
+    def offsets(self, index, i):
+        return struct.unpack_from('<QQ', self.mm, index + 8 * i)
+
+    def rawtoken(self, i):
+        start, end = self.offsets(self.token_index, i)
+        return self.mm[self.token_data + start:self.token_data + end]
+
+    def findtoken(self, raw):
+        lo, hi = 0, self.nr_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = struct.unpack_from('<I', self.mm,
+                                   self.token_order + 4 * mid)[0]
+            r = self.rawtoken(i)
+            if r < raw:
+                lo = mid + 1
+            elif raw < r:
+                hi = mid
+            else:
+                return i
+        return None
+
+    def key(self, n):
+        start, end = self.offsets(self.key_index, n)
+        return tuple(unpack(self.mm[self.key_data + start:
+                                    self.key_data + end]))
+
+    def find(self, nkey):
+        lo, hi = 0, self.nr_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self.key(mid)
+            if k < nkey:
+                lo = mid + 1
+            elif nkey < k:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def nr_successors(self):
+        index = unpack(self.mm[self.succ_index:
+                               self.succ_index + 8 * (self.nr_keys + 1)],
+                       self.OFFSET)
+        return [(index[n + 1] - index[n]) // 8 for n in range(self.nr_keys)]
+
+    def successors(self, n):
+        start, end = self.offsets(self.succ_index, n)
+        vals = unpack(self.mm[self.succ_data + start:self.succ_data + end])
+        half = len(vals) // 2
+        return vals[:half], vals[half:]
+
+    def entries(self):
+        for n in range(self.nr_keys):
+            ids, counts = self.successors(n)
+            yield self.key(n), ids, counts
+
+    def close(self):
+        self.mm.close()
+        self.fp.close()
+
+    @classmethod
+    def write(cls, fp, generation, tokens, entries):
+        # tokens are serialized tokens ordered by id, entries are
+        # (normalized key, ids, counts) sorted by the key.
+        order = sorted(range(len(tokens)), key=tokens.__getitem__)
+        token_index = array.array(cls.OFFSET, [0])
+        for token in tokens:
+            token_index.append(token_index[-1] + len(token))
+
+        header = [0] * 7
+        fp.write(b'\0' * cls.HEADER.size)
+
+        header[0] = fp.tell()
+        fp.write(pack(token_index))
+        header[1] = fp.tell()
+        fp.write(pack(array.array('I', order)))
+        header[2] = fp.tell()
+        for token in tokens:
+            fp.write(token)
+
+        header[3] = fp.tell()
+        keys = array.array('I')
+        key_index = array.array(cls.OFFSET, [0])
+        succ_index = array.array(cls.OFFSET, [0])
+        for nkey, ids, counts in entries:
+            data = pack(array.array('I', ids) + array.array('I', counts))
+            fp.write(data)
+            keys.extend(nkey)
+            key_index.append(len(keys) * 4)
+            succ_index.append(succ_index[-1] + len(data))
+
+        header[4] = fp.tell()
+        fp.write(pack(key_index))
+        header[5] = fp.tell()
+        fp.write(pack(succ_index))
+        header[6] = fp.tell()
+        fp.write(pack(keys))
+
+        fp.seek(0)
+        fp.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, generation,
+                                 len(tokens), len(key_index) - 1, *header))
+
+
+class Vocabulary(object):
+    # tokens are counted by references from the keys and successors in
+    # memory.  unreferenced tokens of the snapshot are dropped from the
+    # cache, and the ids of the others are reused.
+    TOKEN_BYTES = 95            # entries of ids, tokens and refs
+
+    def __init__(self, tokens=(), base=None):
+        self.base = base
+        self.nr_base = base.nr_tokens if base else 0
+        self.ids = {}
+        self.tokens = []
+        self.cache = {}
+        self.refs = {}
+        self.free = []
+        self.nbytes = 0
+        for token in tokens:
+            self.intern(token)
+
+    def intern(self, token):
+        i = self.lookup(token)
+        if i is None:
+            token = self.freeze(token)
+            if self.free:
+                i = self.free.pop()
+                self.tokens[i - self.nr_base] = token
+            else:
+                i = self.nr_base + len(self.tokens)
+                self.tokens.append(token)
+            self.ids[token] = i
+            self.nbytes += self.footprint(token)
+        return i
+
+    def lookup(self, token):
+        token = self.freeze(token)
+        i = self.ids.get(token)
+        if i is None and self.base:
+            i = self.base.findtoken(self.raw(token))
+        return i
+
+    def token(self, i):
+        if i >= self.nr_base:
+            return self.tokens[i - self.nr_base]
+        try:
+            return self.cache[i]
+        except KeyError:
+            return self.load(i)
+
+    def load(self, i):
+        return self.freeze(json.loads(self.base.rawtoken(i).decode('utf-8')))
+
+    def incref(self, ids):
+        for i in ids:
+            n = self.refs.get(i, 0)
+            self.refs[i] = n + 1
+            if not n and i < self.nr_base:
+                token = self.cache[i] = self.load(i)
+                self.ids[token] = i
+                self.nbytes += self.footprint(token)
+
+    def decref(self, ids):
+        for i in ids:
+            n = self.refs[i] - 1
+            if n:
+                self.refs[i] = n
+            else:
+                del self.refs[i]
+                self.release(i)
+
+    def release(self, i):
+        if i < self.nr_base:
+            token = self.cache.pop(i)
+        else:
+            token = self.tokens[i - self.nr_base]
+            self.tokens[i - self.nr_base] = None
+            self.free.append(i)
+        if self.ids.get(token) == i:
+            del self.ids[token]
+        self.nbytes -= self.footprint(token)
+
+    def sweep(self):
+        for i in range(self.nr_base, len(self)):
+            if i not in self.refs and self.token(i) is not None:
+                self.release(i)
+
+    def __len__(self):
+        return self.nr_base + len(self.tokens)
+
+    @staticmethod
+    def raw(token):
+        return db.Database.serialize(token).encode('utf-8')
+
+    @classmethod
+    def freeze(cls, token):
+        if isinstance(token, (list, tuple)):
+            return tuple(cls.freeze(t) for t in token)
+        return token
+
+    @classmethod
+    def footprint(cls, token):
+        size = sys.getsizeof(token)
+        if isinstance(token, tuple):
+            size += sum(cls.footprint(t) - cls.TOKEN_BYTES for t in token)
+        return size + cls.TOKEN_BYTES
+
+
+# successors of a key are stored inline as an int of
+#
+#   id | count << 32 | slot << 64 | use << 96 | pos << 128
+#
+# when it has only one, and in an array of
+#
+#   slot, use, pos, id, count, id, count, ...
+#
+# otherwise.  the slot indexes the key for random selection, the use counts
+# its accesses for eviction, and the pos indexes it in Dict.fixed.
+SLOT, USE, POS = range(3)
+HEADER = 3
+MASK = 0xffffffff
+LARGE = 64                      # successors scanned linearly
+
+
+class Successors(array.array):
+    # array of a key with more than LARGE successors, along with their
+    # positions and a Fenwick tree over their counts
+    __slots__ = ('index', 'weights')
+
+    def __new__(cls, data):
+        return array.array.__new__(cls, 'I', data)
+
+    def __init__(self, data):
+        self.index = dict((i, j) for j, i in enumerate(self[HEADER::2]))
+        self.weights = Weights(self.tolist()[HEADER + 1::2])
+
+
+def successors(ids, counts, slot):
+    if len(ids) == 1:
+        return ids[0] | counts[0] << 32 | slot << 64
+    vals = array.array('I', (slot, 0, 0))
+    for pair in zip(ids, counts):
+        vals.extend(pair)
+    return Successors(vals) if len(ids) > LARGE else vals
+
+
+def field(vals, f):
+    if isinstance(vals, array.array):
+        return vals[f]
+    return vals >> (64 + 32 * f) & MASK
+
+
+def setfield(vals, f, x):
+    if isinstance(vals, array.array):
+        vals[f] = x
+        return vals
+    shift = 64 + 32 * f
+    return vals & ~(MASK << shift) | x << shift
+
+
+def nr_items(vals):
+    if isinstance(vals, array.array):
+        return (len(vals) - HEADER) // 2
+    return 1
+
+
+def items(vals):
+    if isinstance(vals, array.array):
+        return vals[HEADER::2], vals[HEADER + 1::2]
+    return [vals & MASK], [vals >> 32 & MASK]
+
+
+def add(vals, i):
+    # the successors with one more i, and whether i is new to them.  an
+    # array only grows, so that walks may read it while it is updated.
+    if not isinstance(vals, array.array):
+        if vals & MASK != i:
+            return array.array('I', (
+                field(vals, SLOT), field(vals, USE), field(vals, POS),
+                vals & MASK, vals >> 32 & MASK, i, 1)), True
+        if vals >> 32 & MASK == MASK:
+            raise OverflowError('count of %d overflows' % i)
+        return vals + (1 << 32), False
+
+    if isinstance(vals, Successors):
+        j = vals.index.get(i)
+        if j is None:
+            j = vals.index[i] = len(vals.index)
+            vals.extend((i, 1))
+            vals.weights.set(j, 1)
+            return vals, True
+        vals[HEADER + 2 * j + 1] += 1
+        vals.weights.add(j, 1)
+        return vals, False
+
+    try:
+        j = vals[HEADER::2].index(i)
+    except ValueError:
+        vals.extend((i, 1))
+        if len(vals) > HEADER + 2 * LARGE:
+            vals = Successors(vals)
+        return vals, True
+    vals[HEADER + 2 * j + 1] += 1
+    return vals, False
+
+
+def choice(vals):
+    if not isinstance(vals, array.array):
+        return vals & MASK
+
+    if isinstance(vals, Successors):
+        j = vals.weights.find(random.randrange(vals.weights.total()))
+        return vals[HEADER + 2 * j]
+
+    counts = vals[HEADER + 1::2]
+    r = random.randrange(sum(counts))
+    for j, n in enumerate(counts):
+        r -= n
+        if r < 0:
+            return vals[HEADER + 2 * j]
+
+
+class Weights(object):
+    # Fenwick tree over the key slots.
+    def __init__(self, weights=()):
+        self.tree = array.array(Snapshot.OFFSET, [0])
+        self.tree.extend(weights)
+        for i in range(1, len(self.tree)):
+            j = i + (i & -i)
+            if j < len(self.tree):
+                self.tree[j] += self.tree[i]
+
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def get(self, i):
+        return self.prefix(i + 1) - self.prefix(i)
+
+    def add(self, i, n):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += n
+            i += i & -i
+
+    def set(self, i, w):
+        if i + 1 < len(self.tree):
+            self.add(i, w - self.get(i))
+            return
+
+        while len(self.tree) <= i + 1:
+            j = len(self.tree)
+            w_j = w if j == i + 1 else 0
+            self.tree.append(w_j + self.prefix(j - 1) -
+                             self.prefix(j - (j & -j)))
+
+    def total(self):
+        return self.prefix(len(self.tree) - 1)
+
+    def find(self, r):
+        # the slot whose cumulative weight range contains r
+        pos = 0
+        step = 1 << (len(self.tree).bit_length() - 1)
+        while step:
+            if pos + step < len(self.tree) and self.tree[pos + step] <= r:
+                pos += step
+                r -= self.tree[pos]
+            step >>= 1
+        return pos
+
 
 @db.dbclass(db.DBTYPE_MARKOV, db.DBTYPE_ENTRYPOINT)
 class Dict(db.Database):
-    def __init__(self, path=None, **kw):
+    AGING = 16                  # log2 of accesses per epoch
+    SAMPLES = 5                 # keys sampled for an eviction
+    EVICTIONS = 2               # max evictions per append
+
+    # estimated sizes in memory
+    KEY_BYTES = 40              # entries of table, and added or fixed
+    REMOVED_BYTES = 120         # a snapshot key in removed or moved
+
+    def __init__(self, path=None, compact_size=1 << 26, fsync='false',
+                 weighted='false', max_keys=0, max_bytes=0, **kw):
         self.path = path
+        self.compact_size = int(compact_size)
+        self.fsync = str(fsync).lower() == 'true'
+        self.weighted = str(weighted).lower() == 'true'
+        self.max_keys = int(max_keys)
+        self.max_bytes = int(max_bytes)
+        self.evictions = 0
+        self.clock = 0
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.log = None
         self.load()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        try:
+            yield
+        finally:
+            self.flush()
+
     def append(self, key, item):
-        key = self.serialize(key)
-        self.table.setdefault(key, [])
-        self.table[key].append(item)
+        with self.lock:
+            encoded = self.insert(key, item)
+            self.record([key, item])
+            self.evict(encoded)
+
+    def remove(self, key):
+        with self.lock:
+            if self.delete(self.encode(key)):
+                self.record([key])
+
+    def record(self, data):
+        if self.log:
+            self.log.write((self.serialize(data) + '\n').encode('utf-8'))
+
+    def insert(self, key, item):
+        key = self.encode(key, True)
+        i = self.vocab.intern(item)
+        vals = self.entry(key)
+        if vals is None:
+            slot = self.length()
+            self.added.append(key)
+            self.admit(key, successors((i,), (1,), slot))
+            if self.weights:
+                self.weights.set(slot, 1)
+        else:
+            size = self.sizeof(vals)
+            vals, new = add(vals, i)
+            self.table[key] = vals
+            self.nbytes += self.sizeof(vals) - size
+            if new:
+                self.vocab.incref((i,))
+                if self.weights:
+                    self.weights.add(field(vals, SLOT), 1)
+        self.touch(key)
+        return key
+
+    def delete(self, key):
+        # swap the last slot into the one of the key.  the key moved is
+        # paged in to carry its new slot.
+        vals = self.entry(key)
+        if vals is None:
+            return False
+
+        slot = field(vals, SLOT)
+        last = self.length() - 1
+        moved = self.keyat(last)
+        self.entry(moved)
+
+        self.discard(key)
+        if self.base and key not in self.removed and \
+                self.base.find(self.base.normalize(key)) is not None:
+            self.removed.add(key)
+            self.nbytes += self.REMOVED_BYTES
+
+        if slot != last:
+            self.place(moved, slot)
+
+        if last >= self.nr_fixed:
+            self.added.pop()
+        else:
+            if self.moved.pop(last, None) is not None:
+                self.nbytes -= self.REMOVED_BYTES
+            self.nr_fixed -= 1
+
+        if self.weights:
+            w = self.weights.get(last)
+            self.weights.set(last, 0)
+            if slot != last:
+                self.weights.set(slot, w)
+
+        return True
+
+    def admit(self, key, vals):
+        # keys at the slots of the snapshot are listed in self.fixed, so
+        # that the keys in memory can be sampled along with self.added
+        if field(vals, SLOT) < self.nr_fixed:
+            vals = setfield(vals, POS, len(self.fixed))
+            self.fixed.append(key)
+        self.table[key] = vals
+        self.vocab.incref(self.keyids(key))
+        self.vocab.incref(items(vals)[0])
+        self.nbytes += self.footprint(key, vals)
+
+    def discard(self, key):
+        # swap the last fixed key into the position of the key
+        vals = self.table.pop(key)
+        if field(vals, SLOT) < self.nr_fixed:
+            last = self.fixed.pop()
+            if last != key:
+                pos = field(vals, POS)
+                self.fixed[pos] = last
+                self.table[last] = setfield(self.table[last], POS, pos)
+        self.vocab.decref(self.keyids(key))
+        self.vocab.decref(items(vals)[0])
+        self.nbytes -= self.footprint(key, vals)
+
+    def evict(self, keep):
+        # sampled LFU: drop the least used of a few random keys.  keys in
+        # memory are sampled for max_bytes, which the others do not cost.
+        for x in range(self.EVICTIONS):
+            if self.max_keys and self.length() > self.max_keys:
+                resident = False
+            elif self.max_bytes and self.table and \
+                    self.memory() > self.max_bytes:
+                resident = True
+            else:
+                return
+
+            epoch = self.epoch()
+            victim = None
+            score = None
+            for y in range(self.SAMPLES):
+                if resident:
+                    n = random.randrange(len(self.table))
+                    key = self.added[n] if n < len(self.added) else \
+                        self.fixed[n - len(self.added)]
+                else:
+                    key = self.keyat(random.randrange(self.length()))
+                if key == keep:
+                    continue
+                vals = self.table.get(key)
+                # snapshot keys not paged in have not been used since loaded
+                s = self.score(vals, epoch) if vals is not None else 0
+                if score is None or s < score:
+                    victim, score = key, s
+                if not s:
+                    break
+
+            if victim is None:
+                return
+
+            key = self.decode(victim)
+            self.delete(victim)
+            self.record([key])
+            self.evictions += 1
+
+    def memory(self):
+        size = self.nbytes + self.vocab.nbytes
+        if self.weights:
+            size += self.weights.tree.itemsize * len(self.weights.tree)
+        return size
+
+    def epoch(self):
+        return self.clock >> self.AGING & 0xffff
+
+    @staticmethod
+    def score(vals, epoch):
+        # access frequency in the low half of the use, halved on every
+        # epoch passed since the one in the high half
+        use = field(vals, USE)
+        age = (epoch - (use >> 16)) & 0xffff
+        return (use & 0xffff) >> age if age < 16 else 0
+
+    def touch(self, key):
+        # accesses only matter to eviction.  inline successors are
+        # replaced on update, which has to be serialized with appends.
+        if not (self.max_keys or self.max_bytes):
+            return
+
+        with self.lock:
+            self.clock += 1
+            vals = self.table.get(key)
+            if vals is not None:
+                epoch = self.epoch()
+                n = min(self.score(vals, epoch) + 1, 0xffff)
+                self.table[key] = setfield(vals, USE, epoch << 16 | n)
+
+    @classmethod
+    def footprint(cls, key, vals):
+        size = cls.KEY_BYTES + cls.sizeof(vals)
+        if isinstance(key, tuple):
+            size += sys.getsizeof(key)
+        return size
+
+    @staticmethod
+    def sizeof(vals):
+        # inline successors grow with their fields, so are counted at
+        # their largest
+        if not isinstance(vals, array.array):
+            return sys.getsizeof(MASK << 128)
+        size = sys.getsizeof(vals)
+        if isinstance(vals, Successors):
+            size += sys.getsizeof(vals.index) + \
+                sys.getsizeof(vals.weights.tree)
+        return size
+
+    @staticmethod
+    def keyids(key):
+        return key if isinstance(key, tuple) else (key,)
+
+    def slotof(self, key):
+        vals = self.table.get(key)
+        if vals is not None:
+            return field(vals, SLOT)
+        return self.base.find(self.base.normalize(key))
+
+    def keyat(self, slot):
+        if slot >= self.nr_fixed:
+            return self.added[slot - self.nr_fixed]
+        try:
+            return self.moved[slot]
+        except KeyError:
+            return self.base.denormalize(self.base.key(slot))
+
+    def place(self, key, slot):
+        vals = self.table[key]
+        if slot >= self.nr_fixed:
+            self.added[slot - self.nr_fixed] = key
+        else:
+            if slot not in self.moved:
+                self.nbytes += self.REMOVED_BYTES
+            self.moved[slot] = key
+            if field(vals, SLOT) >= self.nr_fixed:
+                vals = setfield(vals, POS, len(self.fixed))
+                self.fixed.append(key)
+        self.table[key] = setfield(vals, SLOT, slot)
+
+    def entry(self, key):
+        # keys of the snapshot are paged in on first access, and shadowed
+        # by the table from then on.
+        vals = self.table.get(key)
+        if vals is not None or key is None or not self.base:
+            return vals
+
+        with self.lock:
+            vals = self.table.get(key)
+            if vals is None and key not in self.removed:
+                n = self.base.find(self.base.normalize(key))
+                if n is not None:
+                    self.admit(key, successors(*self.base.successors(n),
+                                               slot=n))
+                    vals = self.table[key]
+            return vals
 
     def get(self, key):
-        vals = self.table.get(self.serialize(key), None)
+        vals = self.counts(key)
         if not vals:
             return None
-        return vals
+        return [item for item, n in vals for x in range(n)]
+
+    def counts(self, key):
+        key = self.encode(key)
+        vals = self.entry(key)
+        if vals is None:
+            return None
+        self.touch(key)
+        return [(self.vocab.token(i), n) for i, n in zip(*items(vals))]
 
     def getrand(self, key):
         try:
-            return random.choice(self.table[self.serialize(key)])
+            key = self.encode(key)
+            vals = self.entry(key)
+            self.touch(key)
+            return self.vocab.token(choice(vals))
         except Exception:
             return None
 
-    def getrandall(self):
+    def getrandall(self, weighted=None):
+        if weighted is None:
+            weighted = self.weighted
+
         try:
-            return random.choice(random.choice(list(self.table.values())))
+            if weighted:
+                slot = self.getweights().find(
+                    random.randrange(self.weights.total()))
+            else:
+                slot = random.randrange(self.length())
+            key = self.keyat(slot)
+            vals = self.entry(key)
+            self.touch(key)
+            return self.vocab.token(choice(vals))
         except Exception:
             return None
 
+    def getweights(self):
+        # weights by the number of successors, built on first use
+        with self.lock:
+            if self.weights is None:
+                if self.base:
+                    weights = self.base.nr_successors()[:self.nr_fixed]
+                else:
+                    weights = []
+                weights.extend(nr_items(self.table[k]) for k in self.added)
+                for key, vals in self.table.items():
+                    weights[field(vals, SLOT)] = nr_items(vals)
+                self.weights = Weights(weights)
+            return self.weights
+
+    def walk(self, key, maxchain):
+        key = self.encode(tuple(key))
+        if key is None:
+            return
+
+        for x in range(maxchain):
+            vals = self.entry(key)
+            if vals is None:
+                break
+
+            self.touch(key)
+            i = choice(vals)
+            yield self.vocab.token(i)
+            key = key[1:] + (i,)
+
     def keys(self):
-        return [self.deserialize(k) for k in self.table.keys()]
+        keys = [self.decode(k) for k in self.table.keys()]
+        if self.base:
+            for n in range(self.base.nr_keys):
+                key = self.base.denormalize(self.base.key(n))
+                if key not in self.table and key not in self.removed:
+                    keys.append(self.decode(key))
+        return keys
 
     def length(self):
-        return len(self.table)
+        return self.nr_fixed + len(self.added)
+
+    def stats(self):
+        return {'bytes': self.memory(), 'evictions': self.evictions}
+
+    def encode(self, key, create=False):
+        f = self.vocab.intern if create else self.vocab.lookup
+        if not isinstance(key, (list, tuple)):
+            return f(key)
+        key = tuple(f(k) for k in key)
+        return None if None in key else key
+
+    def decode(self, key):
+        if not isinstance(key, tuple):
+            return self.vocab.token(key)
+        return [self.vocab.token(i) for i in key]
 
     def load(self):
-        self.table = {}
+        self.readsnapshot(self.path)
 
         if not self.path:
             return
 
-        try:
-            with codecs.open(self.path, encoding='utf-8') as fp:
-                fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
-                self.table = json.load(fp)
-        except IOError as e:
-            if e.errno != errno.ENOENT:
-                raise
+        size = 0
+        for gen in self.logs():
+            if gen >= self.generation:
+                self.generation = gen
+                size = self.replay(self.logpath(gen))
+
+        self.log = open(self.logpath(self.generation), 'ab')
+        self.log.truncate(size)
+
+    def readsnapshot(self, path):
+        # keys are indexed by slots for random selection.  keys of the
+        # snapshot sit at their index unless moved by a removal, and the
+        # others follow in self.added.
+        self.table = {}
+        self.fixed = []
+        self.base = None
+        self.vocab = Vocabulary()
+        self.generation = 0
+        self.nr_fixed = 0
+        self.added = []
+        self.moved = {}
+        self.removed = set()
+        self.weights = None
+        self.nbytes = 0
+
+        if not path or not os.path.exists(path):
+            return
+
+        if Snapshot.probe(path):
+            self.base = Snapshot(path)
+            self.vocab = Vocabulary(base=self.base)
+            self.generation = self.base.generation
+            self.nr_fixed = self.base.nr_keys
+            return
+
+        with codecs.open(path, encoding='utf-8') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
+            data = json.load(fp)
+
+        if 'vocab' not in data:        # table format of the older versions
+            for key, vals in data.items():
+                for item in vals:
+                    self.insert(self.deserialize(key), item)
+        else:
+            self.vocab = Vocabulary(data['vocab'])
+            self.generation = data.get('generation', 0)
+            for key, ids, counts in data['table']:
+                key = tuple(key) if isinstance(key, list) else key
+                self.admit(key, successors(ids, counts, len(self.added)))
+                self.added.append(key)
+            self.vocab.sweep()
+
+    def writesnapshot(self, path, generation, state):
+        tokens, table, removed = state
+        if self.base:
+            tokens = [self.base.rawtoken(i)
+                      for i in range(self.base.nr_tokens)] + tokens
+        base = self.base.entries() if self.base else ()
+        base = (e for e in base
+                if self.base.denormalize(e[0]) not in table and
+                self.base.denormalize(e[0]) not in removed)
+        overlay = sorted((Snapshot.normalize(k), ids, counts)
+                         for k, (ids, counts) in table.items())
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            Snapshot.write(fp, generation, tokens,
+                           heapq.merge(base, overlay))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, path)
+
+    def state(self):
+        with self.lock:
+            tokens = self.vocab.tokens[:]
+            table = dict((k, items(v)) for k, v in self.table.items())
+            removed = set(self.removed)
+        return ([self.vocab.raw(t) for t in tokens], table, removed)
+
+    def replay(self, path):
+        size = 0
+        with open(path, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break                  # torn by a crash while writing
+                try:
+                    data = self.deserialize(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if len(data) == 1:
+                    self.delete(self.encode(data[0]))
+                else:
+                    self.insert(*data)
+                size += len(line)
+        return size
+
+    def logpath(self, gen):
+        return '%s.%d.log' % (self.path, gen)
+
+    def logs(self):
+        dirname, basename = os.path.split(os.path.abspath(self.path))
+        pattern = re.compile(re.escape(basename) + r'\.(\d+)\.log$')
+        gens = []
+        for name in os.listdir(dirname):
+            m = pattern.match(name)
+            if m:
+                gens.append(int(m.group(1)))
+        return sorted(gens)
+
+    def flush(self):
+        if not self.log:
+            return
+
+        with self.lock:
+            self.log.flush()
+            if self.fsync:
+                os.fsync(self.log.fileno())
+            size = self.log.tell()
+
+        if size >= self.compact_size:
+            if not (self.compactor and self.compactor.is_alive()):
+                self.compactor = threading.Thread(target=self.save)
+                self.compactor.daemon = True
+                self.compactor.start()
 
     def save(self):
         if not self.path:
             return
 
-        with codecs.open(self.path, mode='a+', encoding='utf-8') as fp:
-            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
-            fp.truncate(0)
-            fp.seek(0, 0)
-            json.dump(self.table, fp, ensure_ascii=False, indent=4)
+        # the snapshot loaded at startup stays mapped and immutable, so
+        # only the table has to be captured while appends are blocked.
+        with self.lock:
+            state = self.state()
+            self.log.close()
+            self.log = open(self.logpath(self.generation + 1), 'ab')
+            self.generation += 1
+            generation = self.generation
+
+        self.writesnapshot(self.path, generation, state)
+
+        for gen in self.logs():
+            if gen < generation:
+                os.remove(self.logpath(gen))
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
 
     def __del__(self):
-        self.save()
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser(
+        description='convert a JSON snapshot of Dict into the binary format')
+    ap.add_argument('src', help='JSON snapshot to read')
+    ap.add_argument('dst', help='binary snapshot to write')
+    args = ap.parse_args()
+
+    d = Dict()
+    d.readsnapshot(args.src)
+    d.writesnapshot(args.dst, d.generation, d.state())
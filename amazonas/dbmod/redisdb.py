@@ -1,32 +1,214 @@
 # -*- coding: utf-8 -*-
 
+import random
+import threading
+import contextlib
+
 import redis
 
 from .. import db
 
+from six.moves import range
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def getpool(host, port, db):
+    with _POOLS_LOCK:
+        try:
+            return _POOLS[host, port, db]
+        except KeyError:
+            pool = redis.ConnectionPool(host=host, port=port, db=db)
+            _POOLS[host, port, db] = pool
+            return pool
+
+
+# successors are kept in a hash of counts, and the key is registered in
+# KEYS[2].  sets written by the older versions are converted on the first
+# append.
+APPEND = '''
+local key = KEYS[1]
+if redis.call('TYPE', key).ok == 'set' then
+    local vals = redis.call('SMEMBERS', key)
+    redis.call('DEL', key)
+    for i, v in ipairs(vals) do
+        redis.call('HSET', key, v, 1)
+    end
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+return redis.call('HINCRBY', key, ARGV[1], 1)
+'''
+
+# picks a successor in proportion to its count.  r is a random number in
+# [0, 1) given by the client since math.random is not random in scripts.
+PICK = '''
+local function pick(key, r)
+    if redis.call('TYPE', key).ok == 'set' then
+        return redis.call('SRANDMEMBER', key)
+    end
+    local vals = redis.call('HGETALL', key)
+    local total = 0
+    for i = 2, #vals, 2 do
+        total = total + tonumber(vals[i])
+    end
+    r = r * total
+    for i = 2, #vals, 2 do
+        r = r - tonumber(vals[i])
+        if r < 0 then
+            return vals[i - 1]
+        end
+    end
+    return vals[#vals - 1]
+end
+'''
+
+GETRAND = PICK + '''
+return pick(KEYS[1], tonumber(ARGV[1]))
+'''
+
+GETRANDALL = PICK + '''
+local key = redis.call('SRANDMEMBER', KEYS[1])
+if not key then
+    return nil
+end
+return pick(ARGV[2] .. key, tonumber(ARGV[1]))
+'''
+
+# walks the chain from the serialized items of the first key.  the next
+# keys are built the same way as json.dumps() does, so the keys it reads
+# are not declared in KEYS.
+WALK = PICK + '''
+local maxchain = tonumber(ARGV[1])
+local level = tonumber(ARGV[2])
+local prefix = ARGV[3]
+local items = {}
+for i = 1, level do
+    items[i] = ARGV[3 + i]
+end
+
+local result = {}
+for n = 1, maxchain do
+    local key = '[' .. table.concat(items, ', ', n, n + level - 1) .. ']'
+    local item = pick(prefix .. key, tonumber(ARGV[3 + level + n]))
+    if not item then
+        break
+    end
+    result[n] = item
+    items[n + level] = item
+end
+return result
+'''
+
 
 @db.dbclass(db.DBTYPE_MARKOV, db.DBTYPE_ENTRYPOINT)
 class Redis(db.Database):
-    def __init__(self, host='localhost', port=6379, db=0, **kw):
-        self.redis = redis.StrictRedis(host=host, port=int(port), db=int(db))
+    SCAN_COUNT = 1000
 
-    def append(self, key, item):      # XXX: lose probability
-        self.redis.sadd(self.serialize(key), self.serialize(item))
+    def __init__(self, host='localhost', port=6379, db=0, prefix='', **kw):
+        pool = getpool(host, int(port), int(db))
+        self.redis = redis.StrictRedis(connection_pool=pool)
+        self.prefix = prefix
+        self.registry = prefix + '#keys'
+        self.local = threading.local()
+        self.append_script = self.redis.register_script(APPEND)
+        self.getrand_script = self.redis.register_script(GETRAND)
+        self.getrandall_script = self.redis.register_script(GETRANDALL)
+        self.walk_script = self.redis.register_script(WALK)
+
+        if not self.redis.exists(self.registry):
+            self.bootstrap()
+
+    def bootstrap(self):
+        # registers keys of the older versions, which were unprefixed and
+        # not registered.  keys of other namespaces are not valid JSON.
+        if self.prefix:
+            return
+
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.redis.scan(cursor or 0,
+                                           count=self.SCAN_COUNT)
+            registered = []
+            for key in keys:
+                try:
+                    self.deserialize(key)
+                except ValueError:
+                    continue
+                registered.append(key)
+            if registered:
+                self.redis.sadd(self.registry, *registered)
+
+    def rawkey(self, key):
+        return self.prefix + self.serialize(key)
+
+    @property
+    def current_pipeline(self):
+        return getattr(self.local, 'pipeline', None)
+
+    @current_pipeline.setter
+    def current_pipeline(self, pipeline):
+        self.local.pipeline = pipeline
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # appends are buffered and sent at once; reads are not affected.
+        if self.current_pipeline is not None:
+            yield
+            return
+
+        self.current_pipeline = self.redis.pipeline(transaction=False)
+        try:
+            yield
+            self.current_pipeline.execute()
+        finally:
+            self.current_pipeline = None
+
+    def append(self, key, item):
+        self.append_script(keys=[self.rawkey(key), self.registry],
+                           args=[self.serialize(item), self.serialize(key)],
+                           client=self.current_pipeline or self.redis)
 
     def get(self, key):
-        vals = self.redis.smembers(self.serialize(key))
-        return [self.deserialize(v) for v in vals] if vals else None
+        vals = self.counts(key)
+        if not vals:
+            return None
+        return [item for item, n in vals for x in range(n)]
+
+    def counts(self, key):
+        key = self.rawkey(key)
+        try:
+            vals = self.redis.hgetall(key)
+        except redis.ResponseError:     # set of the older versions
+            vals = dict((v, 1) for v in self.redis.smembers(key))
+        if not vals:
+            return None
+        return [(self.deserialize(k), int(n)) for k, n in vals.items()]
 
     def getrand(self, key):
-        val = self.redis.srandmember(self.serialize(key))
+        val = self.getrand_script(keys=[self.rawkey(key)],
+                                  args=[random.random()])
         return None if val is None else self.deserialize(val)
 
-    def getrandall(self):             # XXX: not atomic
-        key = self.redis.randomkey()
-        return None if key is None else self.getrand(self.deserialize(key))
+    def getrandall(self):
+        val = self.getrandall_script(keys=[self.registry],
+                                     args=[random.random(), self.prefix])
+        return None if val is None else self.deserialize(val)
+
+    def walk(self, key, maxchain):
+        key = [self.serialize(k) for k in key]
+        args = [maxchain, len(key), self.prefix] + key + \
+            [random.random() for x in range(maxchain)]
+        return [self.deserialize(v) for v in self.walk_script(args=args)]
 
     def keys(self):
-        return [self.deserialize(k) for k in self.redis.keys()]
+        return list(self.iterkeys())
+
+    def iterkeys(self, pattern=None):
+        for key in self.redis.sscan_iter(self.registry, match=pattern,
+                                         count=self.SCAN_COUNT):
+            yield self.deserialize(key)
 
     def length(self):
-        return self.redis.dbsize()
+        return self.redis.scard(self.registry)
@@ -1,20 +1,30 @@
 # -*- coding: utf-8 -*-
 
+import random
+import threading
+import importlib
 import contextlib
-
-from sqlalchemy import create_engine
-from sqlalchemy import Integer, String
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship
+import collections
+
+from sqlalchemy import create_engine, inspect, select, and_, tuple_
+from sqlalchemy import bindparam
+from sqlalchemy import Integer, BigInteger, String
+from sqlalchemy import Column, ForeignKey, UniqueConstraint
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool, SingletonThreadPool
+from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import func
 
 from .. import db
 
+from six.moves import range
+
 
 Base = declarative_base()
 
 
+# tables of the older versions, which are only read for the migration.
 class MarkovKey(Base):
     __tablename__ = 'markov_key'
 
@@ -49,94 +59,472 @@ class EntrypointValue(Base):
     value = Column(String(255), nullable=False)
 
 
+# a key is the path of its tokens in a trie of nodes, whose root is 0.
+class MarkovToken(Base):
+    __tablename__ = 'markov_token'
+
+    id = Column(Integer, primary_key=True)
+    token = Column(String(255), unique=True, nullable=False)
+
+
+class MarkovNode(Base):
+    __tablename__ = 'markov_node'
+    __table_args__ = (UniqueConstraint('parent_id', 'token_id'),)
+
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, nullable=False)
+    token_id = Column(Integer, ForeignKey(MarkovToken.id), nullable=False)
+
+
+class MarkovTransition(Base):
+    __tablename__ = 'markov_transition'
+    __table_args__ = (UniqueConstraint('key_id', 'value_id'),)
+
+    id = Column(Integer, primary_key=True)
+    key_id = Column(Integer, ForeignKey(MarkovNode.id), nullable=False)
+    value_id = Column(Integer, ForeignKey(MarkovToken.id), nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+# total counts of transitions by blocks of their ids, for getrandall.
+class MarkovWeight(Base):
+    __tablename__ = 'markov_weight'
+
+    level = Column(Integer, primary_key=True, autoincrement=False)
+    block = Column(Integer, primary_key=True, autoincrement=False)
+    total = Column(BigInteger, nullable=False)
+
+
+class EntrypointToken(Base):
+    __tablename__ = 'entrypoint_token'
+
+    id = Column(Integer, primary_key=True)
+    token = Column(String(255), unique=True, nullable=False)
+
+
+class EntrypointNode(Base):
+    __tablename__ = 'entrypoint_node'
+    __table_args__ = (UniqueConstraint('parent_id', 'token_id'),)
+
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, nullable=False)
+    token_id = Column(Integer, ForeignKey(EntrypointToken.id),
+                      nullable=False)
+
+
+class EntrypointTransition(Base):
+    __tablename__ = 'entrypoint_transition'
+    __table_args__ = (UniqueConstraint('key_id', 'value_id'),)
+
+    id = Column(Integer, primary_key=True)
+    key_id = Column(Integer, ForeignKey(EntrypointNode.id), nullable=False)
+    value_id = Column(Integer, ForeignKey(EntrypointToken.id),
+                      nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+class EntrypointWeight(Base):
+    __tablename__ = 'entrypoint_weight'
+
+    level = Column(Integer, primary_key=True, autoincrement=False)
+    block = Column(Integer, primary_key=True, autoincrement=False)
+    total = Column(BigInteger, nullable=False)
+
+
 @db.dbclass(db.DBTYPE_MARKOV)
 class MarkovSQL(db.Database):
     TABLE_KEY = MarkovKey
     TABLE_VALUE = MarkovValue
-
-    def __init__(self, url, echo='false', **kw):
+    TABLE_TOKEN = MarkovToken
+    TABLE_NODE = MarkovNode
+    TABLE_TRANSITION = MarkovTransition
+    TABLE_WEIGHT = MarkovWeight
+    SCALAR_KEY = False
+    CHUNK_SIZE = 500            # bound parameters of an IN clause
+    BLOCK_BITS = 10             # log2 of ids or blocks in a block
+    LEVELS = 2
+
+    def __init__(self, url, echo='false', pool_size=0, pool_pre_ping='false',
+                 **kw):
         echo = echo.lower() == 'true'
+
+        # file databases of SQLite get no pool by default before
+        # SQLAlchemy 2.0, so that every transaction would connect again.
+        u = make_url(url)
+        poolclass = u.get_dialect().get_pool_class(u)
+        if poolclass is NullPool:
+            poolclass = kw['poolclass'] = QueuePool
+            if u.get_backend_name() == 'sqlite':
+                kw['connect_args'] = {'check_same_thread': False}
+        if int(pool_size) and issubclass(poolclass,
+                                         (QueuePool, SingletonThreadPool)):
+            kw['pool_size'] = int(pool_size)
+        kw['pool_pre_ping'] = str(pool_pre_ping).lower() == 'true'
         self.url = url
-        self.current_session = None
+        self.local = threading.local()
+        self.statements = {}
         self.Engine = create_engine(url, encoding='utf-8', echo=echo, **kw)
-        self.Session = sessionmaker(bind=self.Engine)
-        Base.metadata.create_all(self.Engine, [self.TABLE_KEY.__table__,
-                                               self.TABLE_VALUE.__table__])
+        Base.metadata.create_all(self.Engine, [
+            self.TABLE_TOKEN.__table__,
+            self.TABLE_NODE.__table__,
+            self.TABLE_TRANSITION.__table__,
+            self.TABLE_WEIGHT.__table__,
+        ])
+        self.migrate()
+        self.weigh()
+
+    @property
+    def current_connection(self):
+        return getattr(self.local, 'connection', None)
+
+    @current_connection.setter
+    def current_connection(self, connection):
+        self.local.connection = connection
 
     @contextlib.contextmanager
     def transaction(self):
-        self.current_session = self.Session()
+        # appends are buffered and inserted at once on commit; reads in
+        # the same transaction do not see them.
+        self.current_connection = self.Engine.connect()
+        trans = self.current_connection.begin()
+        self.local.pending = []
+        self.local.tokenids = {}
+        self.local.nodeids = {}
         try:
             yield
-            self.current_session.commit()
+            self.flush()
+            trans.commit()
         except Exception:
-            self.current_session.rollback()
+            trans.rollback()
             raise
         finally:
-            self.current_session.close()
-            self.current_session = None
+            self.current_connection.close()
+            self.current_connection = None
+            self.local.pending = None
+            self.local.tokenids = None
+            self.local.nodeids = None
+
+    def migrate(self):
+        # copies the tables of the older versions into the new ones once
+        old = [self.TABLE_KEY.__table__, self.TABLE_VALUE.__table__]
+        if not all(inspect(self.Engine).has_table(t.name) for t in old):
+            return
+
+        with self.transaction():
+            q = select([self.TABLE_TRANSITION.id]).limit(1)
+            if self.current_connection.execute(q).first() is not None:
+                return
+
+            k, v = old
+            q = select([k.c.key, v.c.value, func.count()])
+            q = q.select_from(k.join(v, v.c.key_id == k.c.id))
+            q = q.group_by(k.c.key, v.c.value)
+            q = q.execution_options(stream_results=True)
+            for key, value, n in self.current_connection.execute(q):
+                self.local.pending.append((self.path(self.deserialize(key)),
+                                           value, n))
+                if len(self.local.pending) >= self.CHUNK_SIZE * 20:
+                    self.flush()
+
+    def weigh(self):
+        # weighs the transitions written before the weights were kept
+        tr = self.TABLE_TRANSITION.__table__
+        w = self.TABLE_WEIGHT.__table__
+
+        with self.transaction():
+            q = select([w.c.level]).limit(1)
+            if self.current_connection.execute(q).first() is not None:
+                return
+
+            totals = collections.Counter()
+            q = select([tr.c.id, tr.c.count])
+            q = q.execution_options(stream_results=True)
+            for id_, n in self.current_connection.execute(q):
+                for level in range(1, self.LEVELS + 1):
+                    totals[level, id_ >> (self.BLOCK_BITS * level)] += n
+            self.reweigh(totals)
 
     def append(self, key, item):
-        key = self.serialize(key)
-        item = self.serialize(item)
-
-        q = self.current_session.query(self.TABLE_KEY)
-        krow = q.filter_by(key=key).first()
-        if not krow:
-            krow = self.TABLE_KEY(key=key)
-            self.current_session.add(krow)
-
-        krow.values.append(self.TABLE_VALUE(value=item))
+        self.local.pending.append((self.path(key), self.serialize(item), 1))
+
+    def path(self, key):
+        if isinstance(key, (list, tuple)):
+            return tuple(self.serialize(k) for k in key)
+        return (self.serialize(key),)
+
+    def flush(self):
+        pending = self.local.pending
+        if not pending:
+            return
+
+        self.local.pending = []
+        tokens = set(v for p, v, n in pending)
+        for p, v, n in pending:
+            tokens.update(p)
+        tokenids = self.tokenids(tokens, True)
+        nodeids = self.nodeids(set(p for p, v, n in pending), True)
+
+        # rows are written in the order of their keys, so that concurrent
+        # flushes lock them in the same order and do not deadlock.
+        counts = collections.Counter()
+        for p, v, n in pending:
+            counts[nodeids[p], tokenids[v]] += n
+        self.upsert(self.TABLE_TRANSITION.__table__, ('key_id', 'value_id'),
+                    'count', [{'key_id': k, 'value_id': v, 'count': n}
+                              for (k, v), n in sorted(counts.items())])
+
+        # the counts are added to the blocks of the transitions as well
+        table = self.TABLE_TRANSITION.__table__
+        pairs = list(counts)
+        totals = collections.Counter()
+        n = self.CHUNK_SIZE // 2
+        for i in range(0, len(pairs), n):
+            q = select([table.c.id, table.c.key_id, table.c.value_id])
+            q = q.where(tuple_(table.c.key_id, table.c.value_id).in_(
+                pairs[i:i + n]))
+            for id_, k, v in self.current_connection.execute(q):
+                for level in range(1, self.LEVELS + 1):
+                    totals[level, id_ >> (self.BLOCK_BITS * level)] += \
+                        counts[k, v]
+        self.reweigh(totals)
+
+    def reweigh(self, totals):
+        if totals:
+            self.upsert(self.TABLE_WEIGHT.__table__, ('level', 'block'),
+                        'total', [{'level': level, 'block': b, 'total': n}
+                                  for (level, b), n in sorted(totals.items())])
+
+    def tokenids(self, tokens, create=False):
+        table = self.TABLE_TOKEN.__table__
+        cache = self.local.tokenids
+
+        def lookup(tokens):
+            for i in range(0, len(tokens), self.CHUNK_SIZE):
+                q = select([table.c.id, table.c.token])
+                q = q.where(table.c.token.in_(tokens[i:i + self.CHUNK_SIZE]))
+                for id_, token in self.current_connection.execute(q):
+                    cache[token] = id_
+
+        missing = [t for t in tokens if t not in cache]
+        lookup(missing)
+
+        if create:
+            missing = sorted(t for t in missing if t not in cache)
+            if missing:
+                self.insert(table, [{'token': t} for t in missing])
+                lookup(missing)
+
+        return cache
+
+    def nodeids(self, paths, create=False):
+        # resolved level by level, from the root.
+        table = self.TABLE_NODE.__table__
+        tokenids = self.tokenids(set(t for p in paths for t in p), create)
+        cache = self.local.nodeids
+        cache[()] = 0
+
+        def lookup(pairs):
+            paths = dict((pair, p) for p, pair in pairs.items())
+            pairs = list(paths)
+            n = self.CHUNK_SIZE // 2
+            for i in range(0, len(pairs), n):
+                q = select([table.c.id, table.c.parent_id, table.c.token_id])
+                q = q.where(tuple_(table.c.parent_id, table.c.token_id).in_(
+                    pairs[i:i + n]))
+                for id_, parent, token in self.current_connection.execute(q):
+                    cache[paths[parent, token]] = id_
+
+        for depth in range(1, max(len(p) for p in paths) + 1):
+            pairs = {}
+            for p in set(p[:depth] for p in paths if len(p) >= depth):
+                if p not in cache and cache.get(p[:-1]) is not None and \
+                        tokenids.get(p[-1]) is not None:
+                    pairs[p] = (cache[p[:-1]], tokenids[p[-1]])
+            lookup(pairs)
+
+            if create:
+                missing = sorted((p for p in pairs if p not in cache),
+                                 key=pairs.get)
+                if missing:
+                    self.insert(
+                        table,
+                        [{'parent_id': pairs[p][0], 'token_id': pairs[p][1]}
+                         for p in missing])
+                    lookup(dict((p, pairs[p]) for p in missing))
+
+        return cache
+
+    def insert(self, table, rows):
+        # rows inserted by the other transactions meanwhile are skipped
+        dialect = self.Engine.dialect.name
+
+        stmt = table.insert()
+        if dialect in ('sqlite', 'postgresql'):
+            stmt = importlib.import_module(
+                'sqlalchemy.dialects.%s' % dialect).insert(table)
+            stmt = stmt.on_conflict_do_nothing()
+        elif dialect == 'mysql':
+            stmt = stmt.prefix_with('IGNORE')
+        self.current_connection.execute(stmt, rows)
+
+    def upsert(self, table, keys, column, rows):
+        # adds the column of the rows to the ones of the same keys
+        dialect = self.Engine.dialect.name
+
+        if dialect in ('sqlite', 'postgresql', 'mysql'):
+            insert = importlib.import_module(
+                'sqlalchemy.dialects.%s' % dialect).insert
+            stmt = insert(table)
+            if dialect == 'mysql':
+                stmt = stmt.on_duplicate_key_update(
+                    {column: table.c[column] + stmt.inserted[column]})
+            else:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c[k] for k in keys],
+                    set_={column: table.c[column] + stmt.excluded[column]})
+            self.current_connection.execute(stmt, rows)
+            return
+
+        stmt = table.update().where(and_(
+            *[table.c[k] == bindparam('b_' + k) for k in keys]))
+        stmt = stmt.values({column: table.c[column] + bindparam('b_n')})
+        for row in rows:
+            params = dict(('b_' + k, row[k]) for k in keys)
+            params['b_n'] = row[column]
+            r = self.current_connection.execute(stmt, params)
+            if not r.rowcount:
+                self.current_connection.execute(table.insert(), row)
 
     def get(self, key):
-        key = self.serialize(key)
-
-        q = self.current_session.query(self.TABLE_KEY)
-        krow = q.filter_by(key=key).first()
-        if not krow:
+        vals = self.counts(key)
+        if not vals:
             return None
+        return [item for item, n in vals for x in range(n)]
 
-        return [self.deserialize(vrow.value) for vrow in krow.values]
+    def statement(self, name, *args):
+        # statements are built once, so that their compiled forms are
+        # reused from the cache of the engine.
+        try:
+            return self.statements[(name,) + args]
+        except KeyError:
+            stmt = getattr(self, '%s_statement' % name)(*args)
+            self.statements[(name,) + args] = stmt
+            return stmt
+
+    def counts_statement(self, depth):
+        # successors of the key whose tokens are bound to t0, t1, ...
+        tok = self.TABLE_TOKEN.__table__
+        node = self.TABLE_NODE.__table__
+        tr = self.TABLE_TRANSITION.__table__
+
+        value = tok.alias()
+        conds = [value.c.id == tr.c.value_id]
+        parent = None
+        for i in range(depth):
+            n = node.alias()
+            t = tok.alias()
+            conds.append(n.c.token_id == t.c.id)
+            conds.append(t.c.token == bindparam('t%d' % i))
+            if parent is None:
+                conds.append(n.c.parent_id == 0)
+            else:
+                conds.append(n.c.parent_id == parent.c.id)
+            parent = n
+        conds.append(tr.c.key_id == parent.c.id)
+
+        return select([value.c.token, tr.c.count]).where(and_(*conds))
+
+    def blocks_statement(self, level):
+        w = self.TABLE_WEIGHT.__table__
+        q = select([w.c.block, w.c.total]).where(w.c.level == level)
+        if level < self.LEVELS:
+            q = q.where(w.c.block.between(bindparam('lo'), bindparam('hi')))
+        return q
+
+    def transitions_statement(self):
+        tr = self.TABLE_TRANSITION.__table__
+        tok = self.TABLE_TOKEN.__table__
+        q = select([tok.c.token, tr.c.count]).where(tok.c.id == tr.c.value_id)
+        return q.where(tr.c.id.between(bindparam('lo'), bindparam('hi')))
+
+    def length_statement(self):
+        tr = self.TABLE_TRANSITION.__table__
+        return select([func.count(tr.c.key_id.distinct())])
+
+    def counts(self, key):
+        p = self.path(key)
+        rows = self.current_connection.execute(
+            self.statement('counts', len(p)),
+            dict(('t%d' % i, t) for i, t in enumerate(p))).fetchall()
+        if not rows:
+            return None
+        return [(self.deserialize(token), n) for token, n in rows]
 
     def getrand(self, key):
-        subq = self.current_session.query(self.TABLE_VALUE)
-        subq = subq.join(self.TABLE_VALUE.key)
-        subq = subq.filter(self.TABLE_KEY.key == self.serialize(key))
-        subq = subq.order_by(self.r).limit(1).subquery()
-        q = self.current_session.query(self.TABLE_VALUE, subq)
-        q = q.filter(self.TABLE_VALUE.id == subq.c.id)
-        vrows = q.first()
-        return self.deserialize(vrows[0].value) if vrows else None
+        return self.choice(self.counts(key) or ())
+
+    @staticmethod
+    def choice(rows):
+        # the first item of a row picked in proportion to the second
+        total = sum(n for x, n in rows)
+        if not total:
+            return None
+
+        r = random.randrange(total)
+        for x, n in rows:
+            r -= n
+            if r < 0:
+                return x
 
     def getrandall(self):
-        subq = self.current_session.query(self.TABLE_VALUE.id)
-        subq = subq.order_by(self.r).limit(1).subquery()
-        q = self.current_session.query(self.TABLE_VALUE, subq)
-        q = q.filter(self.TABLE_VALUE.id == subq.c.id)
-        vrows = q.first()
-        return self.deserialize(vrows[0].value) if vrows else None
+        # descends the blocks of transition ids in proportion to their
+        # totals, so that every observation is equally likely however
+        # sparse the ids are.
+        bits = self.BLOCK_BITS
+        params = {}
+        for level in range(self.LEVELS, 0, -1):
+            block = self.choice(self.current_connection.execute(
+                self.statement('blocks', level), params).fetchall())
+            if block is None:
+                return None
+            params = {'lo': block << bits, 'hi': ((block + 1) << bits) - 1}
+
+        token = self.choice(self.current_connection.execute(
+            self.statement('transitions'), params).fetchall())
+        return None if token is None else self.deserialize(token)
 
     def keys(self):
-        return [self.deserialize(krow.key)
-                for krow in self.current_session.query(self.TABLE_KEY).all()]
+        node = self.TABLE_NODE.__table__
+        tok = self.TABLE_TOKEN.__table__
+        tr = self.TABLE_TRANSITION.__table__
+
+        q = select([node.c.id, node.c.parent_id, tok.c.token])
+        q = q.where(tok.c.id == node.c.token_id)
+        nodes = dict((row.id, (row.parent_id, row.token))
+                     for row in self.current_connection.execute(q))
+
+        keys = []
+        q = select([tr.c.key_id]).distinct()
+        for key_id, in self.current_connection.execute(q):
+            path = []
+            while key_id:
+                key_id, token = nodes[key_id]
+                path.append(self.deserialize(token))
+            path.reverse()
+            keys.append(path[0] if self.SCALAR_KEY else path)
+        return keys
 
     def length(self):
-        return self.current_session.query(self.TABLE_KEY).count()
-
-    @property
-    def r(self):
-        if self.url.startswith('sqlite'):
-            return func.random()
-        if self.url.startswith('mysql'):
-            return func.rand()
-        if self.url.startswith('postgresql'):
-            return func.random()
-        if self.url.startswith('oracle'):
-            return 'dbms_random.value'
-        raise NotImplementedError()
+        return self.current_connection.execute(
+            self.statement('length')).scalar()
 
 
 @db.dbclass(db.DBTYPE_ENTRYPOINT)
 class EntrypointSQL(MarkovSQL):
     TABLE_KEY = EntrypointKey
     TABLE_VALUE = EntrypointValue
+    TABLE_TOKEN = EntrypointToken
+    TABLE_NODE = EntrypointNode
+    TABLE_TRANSITION = EntrypointTransition
+    TABLE_WEIGHT = EntrypointWeight
+    SCALAR_KEY = True
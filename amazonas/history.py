@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import collections
+
+from six.moves import range
+
+
+class History(object):
+    GRAM = 3
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.lines = collections.OrderedDict()
+        self.index = {}
+        self.seq = 0
+
+    def append(self, text):
+        if self.maxlen <= 0:
+            return
+
+        while len(self.lines) >= self.maxlen:
+            self.evict()
+
+        self.lines[self.seq] = text
+        for gram in self.grams(text):
+            self.index.setdefault(gram, set()).add(self.seq)
+        self.seq += 1
+
+    def evict(self):
+        seq, text = self.lines.popitem(last=False)
+        for gram in self.grams(text):
+            seqs = self.index[gram]
+            seqs.discard(seq)
+            if not seqs:
+                del self.index[gram]
+
+    def contains(self, text):
+        if len(text) < self.GRAM:
+            return any(text in line for line in self.lines.values())
+
+        postings = []
+        for gram in self.grams(text):
+            seqs = self.index.get(gram)
+            if not seqs:
+                return False
+            postings.append(seqs)
+
+        postings.sort(key=len)
+        candidates = postings[0]
+        if len(postings) > 1:
+            candidates = candidates & postings[1]
+
+        return any(text in self.lines[seq] for seq in candidates)
+
+    def grams(self, text):
+        n = self.GRAM
+        return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(list(self.lines.values()))
@@ -100,8 +100,10 @@ def _generate(ircbot, conf, conn, event, data):
         entrypoint = None
 
     client = util.http.APIClientV01(conf['server'], conf['port'])
+    budget = float(conf['budget']) if conf.get('budget') else None
     score, text = client.generate(conf['instance'], entrypoint,
-                                  int(conf.get('nr_retry', 0)))
+                                  int(conf.get('nr_retry', 0)),
+                                  budget=budget)
     if None in (score, text):
         logging.warn('[%s] failed to generate text', action)
         return None
@@ -80,8 +80,10 @@ def learn(obj, conf):
 @mmplugin.action('talk')
 def talk(obj, conf):
     client = util.http.APIClientV01(conf['server'], conf['port'])
+    budget = float(conf['budget']) if conf.get('budget') else None
     score, text = client.generate(conf['instance'], None,
-                                  int(conf.get('nr_retry', 0)))
+                                  int(conf.get('nr_retry', 0)),
+                                  budget=budget)
     if None in (score, text):
         logging.warn('[talk] failed to generate text')
         return None
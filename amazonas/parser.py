@@ -68,11 +68,20 @@ class Parser(object):
         return True
 
     def validate_hook(self, parsed):
+        for word, info in parsed:
+            if not self.validate_word(word, info):
+                return False
+        return True
+
+    def validate_word(self, word, info):
         return True
 
     def parse(self, text):
         return []
 
+    def parse_many(self, texts):
+        return [self.parse(text) for text in texts]
+
     @staticmethod
     def split(parsed, chars='\n'):
         data = []
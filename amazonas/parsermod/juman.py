@@ -59,10 +59,9 @@ class Juman(parser.Parser):
             return False
         return True
 
-    def validate_hook(self, parsed):
-        for word, info in parsed:
-            if info[0] == u'特殊' and info[1] in (u'括弧始', u'括弧終'):
-                return False
+    def validate_word(self, word, info):
+        if info[0] == u'特殊' and info[1] in (u'括弧始', u'括弧終'):
+            return False
         return True
 
     def parse(self, text):
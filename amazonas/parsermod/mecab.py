@@ -55,16 +55,21 @@ class Mecab(parser.Parser):
             return False
         return True
 
-    def validate_hook(self, parsed):
-        for word, info in parsed:
-            if info[0] == u'記号' and info[1] in (u'括弧開', u'括弧閉'):
-                return False
+    def validate_word(self, word, info):
+        if info[0] == u'記号' and info[1] in (u'括弧開', u'括弧閉'):
+            return False
         return True
 
     def parse(self, text):
-        result = []
+        return self.parse_many([text])[0]
+
+    def parse_many(self, texts):
         tagger = MeCab.Tagger(self.args)
         encode = tagger.dictionary_info().charset
+        return [self._parselines(tagger, text, encode) for text in texts]
+
+    def _parselines(self, tagger, text, encode):
+        result = []
 
         for text in text.splitlines():
             # MeCab.Tagger.parse only accepts encoded text in python2,
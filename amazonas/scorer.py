@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+import random
+import itertools
+import collections
+
+from six.moves import range
+
+
+def bitmasks(seq):
+    peq = {}
+    for i, c in enumerate(seq):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+
+def distance(peq, m, seq):
+    # bit-parallel Levenshtein distance (Myers 1999, Hyyro 2001) between
+    # the pattern of length m encoded as peq and seq.
+    if not m:
+        return len(seq)
+
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+
+    for c in seq:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return score
+
+
+class Window(object):
+    def __init__(self, maxlen, memo_size=10000):
+        self.ids = {}
+        self.names = []
+        self.data = collections.deque(maxlen=maxlen)
+        self.version = 0
+
+        self.seqs = {}
+        self.seqids = {}
+        self.refs = {}
+        self.sidgen = itertools.count()
+        self.sids = collections.deque(maxlen=maxlen)
+        self.memo_size = memo_size
+        self.memo = collections.OrderedDict()
+        self.memokeys = {}
+        self.sums = {}
+        self.counter = collections.Counter()
+
+    @staticmethod
+    def fromstate(state):
+        cls, maxlen, params = state
+        return cls(maxlen, **params)
+
+    def state(self):
+        # an empty copy is made from the state, and brought up to date by
+        # the deltas
+        return (self.__class__, self.maxlen, self.params())
+
+    def delta(self, version=0, nr_names=0):
+        # names and sequences added since a copy at the version, which had
+        # nr_names names.  sequences pushed out of the window meanwhile
+        # are not needed.
+        n = min(self.version - version, len(self.data))
+        return (version, self.version, nr_names, tuple(self.names[nr_names:]),
+                tuple(itertools.islice(self.data, len(self.data) - n, None)))
+
+    def update(self, delta):
+        base, version, nr_names, names, data = delta
+        if self.version < base or len(self.names) < nr_names:
+            return False
+        if version <= self.version:
+            return True         # applied already, by a later delta
+
+        for c in names[len(self.names) - nr_names:]:
+            self.intern(c)
+        for seq in data[max(len(data) - (version - self.version), 0):]:
+            self.push(seq)
+        self.version = version
+        return True
+
+    def params(self):
+        return {'memo_size': self.memo_size}
+
+    def stats(self):
+        return {
+            'distance_cache_hits':   self.counter['distance_hits'],
+            'distance_cache_misses': self.counter['distance_misses'],
+            'score_cache_hits':      self.counter['score_hits'],
+            'score_cache_misses':    self.counter['score_misses'],
+        }
+
+    @property
+    def maxlen(self):
+        return self.data.maxlen
+
+    def append(self, wordclass):
+        self.push(tuple(self.intern(c) for c in wordclass))
+
+    def push(self, seq):
+        if self.maxlen == 0:
+            return
+
+        evicted = self.sids[0] if len(self.sids) == self.maxlen else None
+
+        sid = self.seqids.get(seq)
+        if sid is None:
+            sid = self.seqids[seq] = next(self.sidgen)
+            self.seqs[sid] = seq
+        self.refs[sid] = self.refs.get(sid, 0) + 1
+
+        self.data.append(seq)
+        self.sids.append(sid)
+        self.sums.clear()
+        self.version += 1
+
+        if evicted is not None:
+            self.release(evicted)
+
+    def release(self, sid):
+        self.refs[sid] -= 1
+        if self.refs[sid]:
+            return
+
+        del self.refs[sid]
+        del self.seqids[self.seqs.pop(sid)]
+        for seq in self.memokeys.pop(sid, ()):
+            del self.memo[seq, sid]
+
+    def intern(self, c):
+        try:
+            return self.ids[c]
+        except KeyError:
+            self.ids[c] = i = len(self.names)
+            self.names.append(c)
+            return i
+
+    def encode(self, wordclass):
+        return tuple(self.ids.get(c, -1) for c in wordclass)
+
+    def distances(self, wordclass):
+        return self.seqdistances(self.encode(wordclass))
+
+    def seqdistances(self, seq):
+        peq = bitmasks(seq)
+        if not self.memo_size:
+            return [distance(peq, len(seq), wcls) for wcls in self.data]
+
+        dist = []
+        for sid, wcls in zip(self.sids, self.data):
+            d = self.memo.pop((seq, sid), None)
+            if d is None:
+                self.counter['distance_misses'] += 1
+                d = distance(peq, len(seq), wcls)
+                self.memokeys.setdefault(sid, set()).add(seq)
+                if len(self.memo) >= self.memo_size:
+                    self.forget()
+            else:
+                self.counter['distance_hits'] += 1
+            self.memo[seq, sid] = d
+            dist.append(d)
+
+        return dist
+
+    def forget(self):
+        (seq, sid), d = self.memo.popitem(last=False)
+        self.memokeys[sid].discard(seq)
+        if not self.memokeys[sid]:
+            del self.memokeys[sid]
+
+    def score(self, wordclass):
+        if len(self.data) <= 1:
+            return 1.0
+
+        seq = self.encode(wordclass)
+        total = self.sums.get(seq)
+
+        if total is None:
+            self.counter['score_misses'] += 1
+            total = sum(self.seqdistances(seq))
+            if self.memo_size:
+                if len(self.sums) >= self.memo_size:
+                    self.sums.clear()
+                self.sums[seq] = total
+        else:
+            self.counter['score_hits'] += 1
+
+        return 1.0 / (float(total) / len(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for wcls in self.data:
+            yield tuple(self.names[i] for i in wcls)
+
+
+class SketchWindow(Window):
+    # approximates the mean edit distance with MinHash signatures of the
+    # word class bigrams.  every signature position works as a LSH table
+    # of one row, which aggregates the lengths of the sequences in it.
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, maxlen, nr_minhash=64, **kw):
+        super(SketchWindow, self).__init__(maxlen, **kw)
+        rand = random.Random(nr_minhash)
+        self.nr_minhash = nr_minhash
+        self.hashes = [(rand.randrange(1, self.PRIME),
+                        rand.randrange(self.PRIME))
+                       for x in range(nr_minhash)]
+        self.sketches = collections.deque()
+        self.lengths = collections.Counter()
+        self.buckets = [{} for x in range(nr_minhash)]
+        self.shipped = {}
+
+    def params(self):
+        params = super(SketchWindow, self).params()
+        params['nr_minhash'] = self.nr_minhash
+        return params
+
+    def delta(self, version=0, nr_names=0):
+        # the sketches are shipped too, which cost far more to compute than
+        # to unpickle
+        delta = super(SketchWindow, self).delta(version, nr_names)
+        n = len(delta[4])
+        return delta + (tuple(sketch for length, sketch in itertools.islice(
+            self.sketches, len(self.sketches) - n, None)),)
+
+    def update(self, delta):
+        self.shipped = dict(zip(delta[4], delta[5]))
+        try:
+            return super(SketchWindow, self).update(delta[:5])
+        finally:
+            self.shipped = {}
+
+    def push(self, seq):
+        if self.maxlen == 0:
+            return
+
+        if len(self.data) == self.maxlen:
+            self.unindex(*self.sketches.popleft())
+
+        super(SketchWindow, self).push(seq)
+        sketch = self.shipped.get(seq) or self.sketch(seq)
+        self.sketches.append((len(seq), sketch))
+        self.index(*self.sketches[-1])
+
+    def index(self, length, sketch):
+        self.lengths[length] += 1
+        for bucket, h in zip(self.buckets, sketch):
+            counts = bucket.get(h)
+            if counts is None:
+                counts = bucket[h] = collections.Counter()
+            counts[length] += 1
+
+    def unindex(self, length, sketch):
+        self.lengths[length] -= 1
+        if not self.lengths[length]:
+            del self.lengths[length]
+
+        for bucket, h in zip(self.buckets, sketch):
+            bucket[h][length] -= 1
+            if not bucket[h][length]:
+                del bucket[h][length]
+            if not bucket[h]:
+                del bucket[h]
+
+    def sketch(self, seq):
+        grams = set(hash(g) for g in zip((-2,) + seq, seq + (-3,)))
+        return tuple(min((a * g + b) % self.PRIME for g in grams)
+                     for a, b in self.hashes)
+
+    def score(self, wordclass):
+        if len(self.data) <= 1:
+            return 1.0
+
+        seq = self.encode(wordclass)
+        la = len(seq)
+
+        # d(a, b) ~= max(|a|, |b|) - J(a, b) * min(|a|, |b|)
+        total = sum(max(la, lb) * n for lb, n in self.lengths.items())
+        common = 0
+        for bucket, h in zip(self.buckets, self.sketch(seq)):
+            for lb, n in bucket.get(h, {}).items():
+                common += min(la, lb) * n
+
+        total -= float(common) / self.nr_minhash
+        return 1.0 / (total / len(self.data))
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import argparse
+
+    def generate(rand, nr_class, maxlen):
+        seq = [rand.randrange(nr_class)]
+        for x in range(rand.randint(0, maxlen - 1)):
+            if rand.random() < 0.7:
+                seq.append((seq[-1] * 7 + 3) % nr_class)
+            else:
+                seq.append(rand.randrange(nr_class))
+        return seq
+
+    def reference(a, b):
+        # O(n * m) dynamic programming, which the bit-parallel distance has
+        # to agree with
+        prev = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            cur = [i]
+            for j in range(1, len(b) + 1):
+                cur.append(min(prev[j] + 1, cur[j - 1] + 1,
+                               prev[j - 1] + int(a[i - 1] != b[j - 1])))
+            prev = cur
+        return prev[-1]
+
+    def bench(window, candidates):
+        start = time.time()
+        scores = [window.score(c) for c in candidates]
+        return scores, (time.time() - start) / len(candidates)
+
+    ap = argparse.ArgumentParser(
+        description='compare the approximate score with the exact one')
+    ap.add_argument('-w', '--window', type=int, nargs='+',
+                    default=[100, 1000, 10000],
+                    help='window sizes to benchmark')
+    ap.add_argument('-n', '--candidates', type=int, default=200,
+                    help='number of candidates to score')
+    ap.add_argument('-c', '--classes', type=int, default=30,
+                    help='number of word classes')
+    ap.add_argument('-l', '--length', type=int, default=20,
+                    help='maximum length of sequences')
+    ap.add_argument('-m', '--minhash', type=int, default=64,
+                    help='number of MinHash functions')
+    ap.add_argument('-s', '--seed', type=int, default=0,
+                    help='random seed')
+    args = ap.parse_args()
+
+    rand = random.Random(args.seed)
+    candidates = [generate(rand, args.classes, args.length)
+                  for x in range(args.candidates)]
+
+    wrong = sum(distance(bitmasks(a), len(a), b) != reference(a, b)
+                for a, b in zip(candidates, candidates[1:]))
+    print('distance: %d of %d pairs differ from the reference' % (
+        wrong, len(candidates) - 1))
+
+    print('%8s %12s %12s %10s %10s' % ('window', 'exact [ms]', 'approx [ms]',
+                                       'mean err', 'max err'))
+
+    for size in args.window:
+        exact = Window(size, memo_size=0)
+        approx = SketchWindow(size, args.minhash, memo_size=0)
+        for x in range(size):
+            seq = generate(rand, args.classes, args.length)
+            exact.append(seq)
+            approx.append(seq)
+
+        e, te = bench(exact, candidates)
+        a, ta = bench(approx, candidates)
+        errors = [abs(x - y) / x for x, y in zip(e, a)]
+
+        print('%8d %12.3f %12.3f %9.2f%% %9.2f%%' % (
+            size, te * 1000, ta * 1000,
+            sum(errors) / len(errors) * 100, max(errors) * 100))
+        sys.stdout.flush()
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
 import random
 import logging
-import operator
+import threading
+import itertools
 import collections
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
 
 from . import db
 from . import parser
 from . import config
+from . import scorer
+from . import history
 
 from six.moves import range
 
@@ -24,6 +32,45 @@ def getparser(type_, instance):
     return c(**d)
 
 
+def textscore(parser, window, text, parsed=None):
+    if parsed is None:
+        parsed = parser.strip(parser.parse(text))
+    if not parser.validate(parsed):
+        return -1
+
+    lines = tuple(line for line in parser.split(parsed) if line)
+    if not lines:
+        return -1
+
+    score = sum(window.score(list(zip(*list(zip(*line))[1]))[0])
+                for line in lines)
+    return score / len(lines)
+
+
+_worker = {}
+
+
+def _initworker(parser, state):
+    _worker['parser'] = parser
+    _worker['window'] = scorer.Window.fromstate(state)
+
+
+def _textscores(args):
+    delta, candidates = args
+
+    # the counters are reported and cleared on every call
+    window = _worker['window']
+    window.counter.clear()
+    if not window.update(delta):
+        scores = None           # too far behind to apply the delta
+    else:
+        scores = [textscore(_worker['parser'], window, text, parsed)
+                  for text, parsed in candidates]
+
+    return (os.getpid(), window.version, len(window.names), scores,
+            window.counter)
+
+
 class MarkovTable(object):
     def __init__(self, db, edb, level=2, maxchain=50):
         self.db = db
@@ -38,31 +85,43 @@ class MarkovTable(object):
                    **config.as_dict('markov:%s' % instance))
 
     def learn(self, itemlist):
+        self.learn_many([itemlist])
+
+    def learn_many(self, itemlists):
         def check(key):
             return len([k for k in key if k]) == len(key)
 
-        entrypoint = None
-        items = [''] * self.level
+        itemlists = list(itemlists)
+        entrypoints = []
 
         with self.db.transaction():
-            for item in itemlist:
-                if check(items):
-                    key = tuple(items)
-                    self.db.append(key, item)
+            for itemlist in itemlists:
+                entrypoint = None
+                items = [''] * self.level
 
-                    if not entrypoint:
-                        entrypoint = key
+                for item in itemlist:
+                    if check(items):
+                        key = tuple(items)
+                        self.db.append(key, item)
 
-                items.pop(0)
-                items.append(item)
+                        if not entrypoint:
+                            entrypoint = key
 
-        if entrypoint:
+                    items.pop(0)
+                    items.append(item)
+
+                if entrypoint:
+                    entrypoints.append(entrypoint)
+
+        if entrypoints:
             with self.edb.transaction():
-                self.edb.append(entrypoint[0], entrypoint)
+                for entrypoint in entrypoints:
+                    self.edb.append(self.word(entrypoint[0]), entrypoint)
 
-        self.maxchain = (self.maxchain + len(itemlist)) // 2
+        for itemlist in itemlists:
+            self.maxchain = (self.maxchain + len(itemlist)) // 2
 
-    def run(self, entrypoint=None):
+    def run(self, entrypoint=None, check=None):
         with self.edb.transaction():
             if entrypoint:
                 items = self.edb.getrand(entrypoint)
@@ -71,18 +130,15 @@ class MarkovTable(object):
         if items is None:
             return []
 
-        items = list(items)
-        data = items[:]
+        data = list(items)
+        if check and not all(check(item) for item in data):
+            return []
 
         with self.db.transaction():
-            for x in range(self.maxchain):
-                item = self.db.getrand(tuple(items))
-                if item is None:
-                    break
-
+            for item in self.db.walk(items, self.maxchain):
+                if check and not check(item):
+                    return []
                 data.append(item)
-                items.pop(0)
-                items.append(item)
 
         return data
 
@@ -90,14 +146,24 @@ class MarkovTable(object):
         with self.db.transaction():
             return self.db.keys()
 
+    def iterkeys(self, pattern=None):
+        with self.db.transaction():
+            for key in self.db.iterkeys(pattern):
+                yield key
+
     def values(self, keys):
         with self.db.transaction():
-            return self.db.get(tuple(keys))
+            return self.db.counts(tuple(keys))
 
     def entrypoints(self):
         with self.edb.transaction():
             return self.edb.keys()
 
+    def iterentrypoints(self, pattern=None):
+        with self.edb.transaction():
+            for key in self.edb.iterkeys(pattern):
+                yield key
+
     def key_length(self):
         with self.db.transaction():
             return len(self.db)
@@ -106,6 +172,17 @@ class MarkovTable(object):
         with self.edb.transaction():
             return len(self.edb)
 
+    def stats(self):
+        stats = {}
+        for name, d in (('markov', self.db), ('entrypoint', self.edb)):
+            for k, v in d.stats().items():
+                stats['%s_%s' % (name, k)] = v
+        return stats
+
+    @staticmethod
+    def word(item):
+        return item[0] if isinstance(item, (list, tuple)) else item
+
 
 class TextGenerator(object):
     def __init__(self, parser, markov, **kw):
@@ -117,11 +194,42 @@ class TextGenerator(object):
         self.nr_wordclass = int(kw.get('nr_wordclass', 100))
         self.nr_entrypoint = int(kw.get('nr_entrypoint', 100))
         self.score_threshold = float(kw.get('score_threshold', 0.0))
-
-        self.history = collections.deque(maxlen=self.nr_history)
-        self.wordclass = collections.deque(maxlen=self.nr_wordclass)
+        self.carry_wordclass = str(
+            kw.get('carry_wordclass', 'false')).lower() == 'true'
+        self.max_length = int(kw.get('max_length', 0))
+        self.time_budget = float(kw.get('time_budget', 0.0))
+        self.nr_workers = int(kw.get('nr_workers', 0))
+        self.nr_procs = int(kw.get('nr_procs', 0))
+        self.nr_minhash = int(kw.get('nr_minhash', 64))
+        self.nr_memo = int(kw.get('nr_memo', 10000))
+        self.score_mode = kw.get('score_mode', 'exact')
+
+        self.history = history.History(self.nr_history)
         self.entrypoint = collections.deque(maxlen=self.nr_entrypoint)
 
+        if self.score_mode == 'approx':
+            self.wordclass = scorer.SketchWindow(self.nr_wordclass,
+                                                 self.nr_minhash,
+                                                 memo_size=self.nr_memo)
+        else:
+            self.wordclass = scorer.Window(self.nr_wordclass,
+                                           memo_size=self.nr_memo)
+        self.pool = None
+        self.procs = None
+        self.synced = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # fork workers before this instance spawns any threads or parser
+        # processes.  the instances created earlier have started threads
+        # of their pools already, but those are idle on the queues of their
+        # own pools, which the workers forked here never use.
+        if self.nr_procs > 0:
+            self.procs = multiprocessing.Pool(
+                self.nr_procs, _initworker,
+                (self.parser, self.wordclass.state()))
+        if self.nr_workers > 1:
+            self.pool = ThreadPool(self.nr_workers)
+
     @classmethod
     def getinstance(cls, instance, markov_cls=MarkovTable):
         markov = markov_cls.getinstance(instance)
@@ -129,96 +237,188 @@ class TextGenerator(object):
                    **config.as_dict('textgen:%s' % instance))
 
     def learn(self, text):
-        parsed = self.parser.strip(self.parser.parse(text))
-        if len(parsed) <= self.markov.level:
-            return
+        self.learn_many([text])
 
-        self.markov.learn(list(zip(*parsed))[0])
-        self.entrypoint.extend(self.parser.entrypoints(parsed))
-        self.history.append(text)
+    def learn_many(self, texts):
+        learned = []
+        for text, parsed in zip(texts, self.parser.parse_many(texts)):
+            parsed = self.parser.strip(parsed)
+            if len(parsed) > self.markov.level:
+                learned.append((text, parsed))
 
-        for line in self.parser.split(parsed):
-            if not line:
-                continue
-            wordclass = list(zip(*list(zip(*line))[1]))[0]
-            self.update_score_threshold(self.score(wordclass))
-            self.wordclass.append(wordclass)
+        if not learned:
+            return
 
-    def run(self, entrypoint=None):
-        for x in range(self.nr_retry):
-            if entrypoint:
-                ep = entrypoint
-            elif self.entrypoint:
-                ep = random.choice(self.entrypoint)
-            else:
-                ep = None
-
-            try:
-                text = ''.join(self.markov.run(ep)).strip()
-            except Exception:
-                logging.exception('failed to generate a text (%d)', x)
-                continue
-            if not text:
-                continue
-            if self.history_contains(text):
-                continue
-
-            score = self.textscore(text)
-            if score < 0:
-                continue
-
-            self.update_score_threshold(score)
-            if self.score_threshold <= score:
-                self.history.append(text)
-                return text, score
+        if self.carry_wordclass:
+            self.markov.learn_many([p for t, p in learned])
+        else:
+            self.markov.learn_many([list(zip(*p))[0] for t, p in learned])
+
+        for text, parsed in learned:
+            self.entrypoint.extend(self.parser.entrypoints(parsed))
+            self.history.append(text)
+
+            for line in self.parser.split(parsed):
+                if not line:
+                    continue
+                wordclass = list(zip(*list(zip(*line))[1]))[0]
+                self.update_score_threshold(self.score(wordclass))
+                self.wordclass.append(wordclass)
+
+    def run(self, entrypoint=None, budget=None):
+        if budget is None:
+            budget = self.time_budget
+        deadline = time.time() + budget if budget > 0 else None
+        best = None, None
+
+        for text, score in self.evaluate(self.candidates(entrypoint,
+                                                         deadline)):
+            if score is not None:
+                if self.score_threshold <= score:
+                    self.history.append(text)
+                    return text, score
+
+                if best[1] is None or best[1] < score:
+                    best = text, score
+
+            if deadline is not None and deadline <= time.time():
+                if best[0] is not None:
+                    self.history.append(best[0])
+                return best
 
         return None, None
 
-    def textscore(self, text):
-        parsed = self.parser.strip(self.parser.parse(text))
-        if not self.parser.validate(parsed):
-            return -1
+    def candidates(self, entrypoint=None, deadline=None):
+        def generate(x):
+            return self.generate(x, entrypoint, deadline)
 
-        lines = tuple(line for line in self.parser.split(parsed) if line)
-        if not lines:
-            return -1
+        if self.pool is None:
+            for x in range(self.nr_retry):
+                yield generate(x)
+            return
 
-        score = sum(self.score(list(zip(*list(zip(*line))[1]))[0])
-                    for line in lines)
-        return score / len(lines)
+        for n in range(0, self.nr_retry, self.nr_workers):
+            wave = range(n, min(n + self.nr_workers, self.nr_retry))
+            for candidate in self.pool.imap_unordered(generate, wave):
+                yield candidate
+
+    def generate(self, x, entrypoint=None, deadline=None):
+        if entrypoint:
+            ep = entrypoint
+        elif self.entrypoint:
+            ep = random.choice(self.entrypoint)
+        else:
+            ep = None
+
+        try:
+            return self.compose(self.markov.run(ep, self.checker(deadline)))
+        except Exception:
+            logging.exception('failed to generate a text (%d)', x)
+            return None, None
+
+    def evaluate(self, candidates):
+        size = max(self.nr_procs, self.nr_workers) if self.procs else 1
+        candidates = iter(candidates)
+
+        while True:
+            batch = list(itertools.islice(candidates, size))
+            if not batch:
+                return
+
+            valid = [(text, parsed) for text, parsed in batch
+                     if text and not self.history_contains(text)]
+            scores = dict(zip((text for text, parsed in valid),
+                              self.textscores(valid)))
+
+            for text, parsed in batch:
+                score = scores.get(text, -1)
+                if score < 0:
+                    yield None, None
+                    continue
+
+                self.update_score_threshold(score)
+                yield text, score
+
+    def textscores(self, candidates):
+        if self.procs is None or len(candidates) <= 1:
+            return [self.textscore(text, parsed)
+                    for text, parsed in candidates]
+
+        # workers are sent what was added to the window since the oldest
+        # version they have reported, and the ones behind it get all.
+        delta = self.wordclass.delta(*self.oldest_synced())
+        n = -(-len(candidates) // self.nr_procs)
+        chunks = [candidates[i:i + n] for i in range(0, len(candidates), n)]
+        results = self.procs.map(_textscores, [(delta, c) for c in chunks])
+
+        scores = []
+        for chunk, (pid, version, nr_names, s, counter) in zip(chunks,
+                                                                results):
+            if s is None:
+                pid, version, nr_names, s, counter = self.procs.apply(
+                    _textscores, ((self.wordclass.delta(), chunk),))
+            with self.lock:
+                self.wordclass.counter.update(counter)
+                self.synced.pop(pid, None)
+                self.synced[pid] = version, nr_names
+                if len(self.synced) > self.nr_procs:
+                    self.synced.popitem(last=False)
+            scores.extend(s)
+        return scores
+
+    def oldest_synced(self):
+        # textscores may run on several threads of the pool
+        with self.lock:
+            if len(self.synced) < self.nr_procs:
+                return 0, 0
+            return (min(v for v, n in self.synced.values()),
+                    min(n for v, n in self.synced.values()))
+
+    def checker(self, deadline=None):
+        length = [0]
+
+        def check(item):
+            if deadline is not None and deadline <= time.time():
+                return False
+
+            word = item
+            if self.carry_wordclass and isinstance(item, (list, tuple)):
+                word, info = item
+                if not self.parser.validate_word(word, info):
+                    return False
+
+            length[0] += len(word)
+            return not self.max_length or length[0] <= self.max_length
+
+        return check
+
+    def compose(self, items):
+        if self.carry_wordclass and items and \
+                all(isinstance(i, (list, tuple)) for i in items):
+            parsed = self.parser.strip(items)
+            return ''.join(w for w, i in parsed), parsed
+
+        return ''.join(self.markov.word(i) for i in items).strip(), None
+
+    def textscore(self, text, parsed=None):
+        return textscore(self.parser, self.wordclass, text, parsed)
 
     def score(self, wordclass):
-        if len(self.wordclass) <= 1:
-            return 1.0
-        dist = [self.distance(wordclass, wcls) for wcls in self.wordclass]
-        return 1.0 / (float(sum(dist)) / len(dist))
+        return self.wordclass.score(wordclass)
+
+    def stats(self):
+        stats = {
+            'threshold':   self.score_threshold,
+            'maxchain':    self.markov.maxchain,
+            'keys':        self.markov.key_length(),
+            'entrypoints': self.markov.entrypoint_length(),
+        }
+        stats.update(self.wordclass.stats())
+        stats.update(self.markov.stats())
+        return stats
 
     def update_score_threshold(self, score):
         self.score_threshold = (self.score_threshold + score) / 2
 
     def history_contains(self, text):
-        for line in self.history:
-            if text in line:
-                return True
-        return False
-
-    @staticmethod
-    def distance(a, b, op=operator.eq):
-        la = len(a) + 1
-        lb = len(b) + 1
-        m = [[0] * lb for i in range(la)]
-
-        for i in range(la):
-            m[i][0] = i
-
-        for j in range(lb):
-            m[0][j] = j
-
-        for i in range(1, la):
-            for j in range(1, lb):
-                x = int(not op(a[i - 1], b[j - 1]))
-                m[i][j] = min(m[i - 1][j] + 1,
-                              m[i][j - 1] + 1,
-                              m[i - 1][j - 1] + x)
-
-        return m[-1][-1]
+        return self.history.contains(text)
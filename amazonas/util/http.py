@@ -181,7 +181,7 @@ class APIClientV01(HTTPClient):
         return False
 
     def generate(self, instance, entrypoint=None,
-                 nr_retry=0, retry_interval=0.2):
+                 nr_retry=0, retry_interval=0.2, budget=None):
         def isvalid(code, body):
             if code != 200:
                 return False
@@ -199,6 +199,8 @@ class APIClientV01(HTTPClient):
 
         path = '/'.join((self.PATH_PREFIX, instance))
         query = {'entrypoint': entrypoint} if entrypoint else {}
+        if budget is not None:
+            query['budget'] = budget
         for x in range(nr_retry + 1):
             code, body = self.get(path, **query)
 
@@ -209,7 +211,8 @@ class APIClientV01(HTTPClient):
 
         return None, None
 
-    def entries(self, instance, nr_retry=0, retry_interval=0.2):
+    def entries(self, instance, nr_retry=0, retry_interval=0.2,
+                match=None):
         def isvalid(code, body):
             if code != 200:
                 return False
@@ -222,8 +225,9 @@ class APIClientV01(HTTPClient):
             return True
 
         path = '/'.join((self.PATH_PREFIX, instance, 'entrypoints'))
+        query = {'match': match} if match else {}
         for x in range(nr_retry + 1):
-            code, body = self.get(path)
+            code, body = self.get(path, **query)
 
             if isvalid(code, body):
                 return body['keys']
@@ -255,7 +259,8 @@ class APIClientV01(HTTPClient):
 
         return None
 
-    def keys(self, instance, nr_retry=0, retry_interval=0.2):
+    def keys(self, instance, nr_retry=0, retry_interval=0.2,
+             match=None):
         def isvalid(code, body):
             if code != 200:
                 return False
@@ -268,8 +273,9 @@ class APIClientV01(HTTPClient):
             return True
 
         path = '/'.join((self.PATH_PREFIX, instance, 'keys'))
+        query = {'match': match} if match else {}
         for x in range(nr_retry + 1):
-            code, body = self.get(path)
+            code, body = self.get(path, **query)
 
             if isvalid(code, body):
                 return body['keys']
@@ -15,12 +15,24 @@ def getinstance(inst):
     return instance.get(inst)
 
 
+def streamkeys(keys):
+    # one key per line, so that the whole list is never built at once.
+    def generate():
+        yield '{"keys": ['
+        for i, key in enumerate(keys):
+            yield (',\n' if i else '\n') + json.dumps(key, ensure_ascii=False)
+        yield '\n]}\n'
+
+    return flask.Response(generate(), mimetype='application/json')
+
+
 @mod.route('/<inst>', methods=['GET', 'PUT'])
 def root(inst):
     inst = getinstance(inst)
 
     if flask.request.method == 'GET':
-        text, sc = inst.run(flask.request.args.get('entrypoint'))
+        text, sc = inst.run(flask.request.args.get('entrypoint'),
+                            flask.request.args.get('budget', type=float))
         if text is not None and sc is not None:
             return flask.jsonify(text=text, score=sc)
         return flask.Response(status=204)
@@ -32,8 +44,7 @@ def root(inst):
     if type(data['text']) is not list:
         flask.abort(400)
 
-    for line in data['text']:
-        inst.learn(line)
+    inst.learn_many(data['text'])
 
     return flask.Response(status=204)
 
@@ -41,7 +52,7 @@ def root(inst):
 @mod.route('/<inst>/keys')
 def keys(inst):
     inst = getinstance(inst)
-    return flask.jsonify(keys=inst.markov.keys())
+    return streamkeys(inst.markov.iterkeys(flask.request.args.get('match')))
 
 
 @mod.route('/<inst>/keys/<path:keys>')
@@ -65,7 +76,8 @@ def values(inst, keys):
 @mod.route('/<inst>/entrypoints')
 def entrypoints(inst):
     inst = getinstance(inst)
-    return flask.jsonify(keys=inst.markov.entrypoints())
+    return streamkeys(
+        inst.markov.iterentrypoints(flask.request.args.get('match')))
 
 
 @mod.route('/<inst>/recent-entrypoints')
@@ -83,7 +95,4 @@ def histories(inst):
 @mod.route('/<inst>/stats')
 def stats(inst):
     inst = getinstance(inst)
-    return flask.jsonify(threshold=inst.score_threshold,
-                         maxchain=inst.markov.maxchain,
-                         keys=inst.markov.key_length(),
-                         entrypoints=inst.markov.entrypoint_length())
+    return flask.jsonify(**inst.stats())